@@ -1,17 +1,45 @@
-from fastapi import FastAPI, HTTPException, BackgroundTasks
+from fastapi import FastAPI, HTTPException, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.middleware.gzip import GZipMiddleware
+from starlette.middleware.gzip import DEFAULT_EXCLUDED_CONTENT_TYPES
 from fastapi.responses import FileResponse, StreamingResponse
 from pydantic import BaseModel
 from typing import List, Optional
-import requests
+from concurrent.futures import ProcessPoolExecutor
+import httpx
 import pandas as pd
 from datetime import datetime, date
-import json
+import orjson
+import ast
 import io
 import uuid
 import os
+import time
+import asyncio
+import multiprocessing
+import random
+from contextlib import asynccontextmanager
 
-app = FastAPI(title="BOAMP Data Extractor", version="1.0.0")
+# Shared HTTP client and process pool, created at startup and closed at shutdown
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    app.state.http = httpx.AsyncClient(
+        timeout=10,
+        limits=httpx.Limits(max_connections=20, max_keepalive_connections=20)
+    )
+    # Process pool for the CPU-bound DataFrame and Excel work of each job.
+    # forkserver avoids forking a process that already runs the event loop and thread pool;
+    # platforms without it (Windows) use spawn.
+    start_method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+    app.state.executor = ProcessPoolExecutor(
+        max_workers=os.cpu_count(),
+        mp_context=multiprocessing.get_context(start_method)
+    )
+    yield
+    await app.state.http.aclose()
+    app.state.executor.shutdown()
+
+app = FastAPI(title="BOAMP Data Extractor", version="1.0.0", lifespan=lifespan)
 
 # CORS middleware
 app.add_middleware(
@@ -22,6 +50,14 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# GZip middleware for large JSON and CSV responses; xlsx is already a ZIP archive
+XLSX_MEDIA_TYPE = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+app.add_middleware(
+    GZipMiddleware,
+    minimum_size=1024,
+    exclude_content_types=(*DEFAULT_EXCLUDED_CONTENT_TYPES, XLSX_MEDIA_TYPE)
+)
+
 # Models
 class ExtractionRequest(BaseModel):
     target_date: str
@@ -38,189 +74,280 @@ class ExtractionResponse(BaseModel):
 # Storage for job results
 jobs = {}
 
-# Main function to get BOAMP records
-def get_all_records_for_date(target_date, max_records=5000):
-    """Get all records for a specific date with all available fields"""
-    url = "https://boamp-datadila.opendatasoft.com/api/explore/v2.1/catalog/datasets/boamp/records"
-    all_records = []
-    offset = 0
-    limit = 100
+# References to running background tasks so they are not garbage-collected mid-run
+background_tasks = set()
+JOB_TTL_SECONDS = 3600
+MAX_STORED_JOBS = 50
+
+def purge_jobs():
+    """Evict finished jobs past their TTL, then the oldest finished ones beyond MAX_STORED_JOBS"""
+    now = time.time()
+    finished = [job_id for job_id, job in jobs.items() if job["status"] in ("completed", "error")]
+
+    for job_id in finished:
+        if now - jobs[job_id]["created_at"] > JOB_TTL_SECONDS:
+            del jobs[job_id]
+
+    # Jobs are stored in creation order, so the first finished ones are the oldest
+    for job_id in [job_id for job_id in finished if job_id in jobs]:
+        if len(jobs) <= MAX_STORED_JOBS:
+            break
+        del jobs[job_id]
+
+def update_job(job_id: str, **fields):
+    """Update job fields and bump the job version used for ETags"""
+    jobs[job_id].update(fields)
+    jobs[job_id]["version"] += 1
+
+def job_etag(job_id: str, resource: str):
+    """Weak ETag for a job resource, derived from the job version"""
+    return f'W/"{job_id}-{jobs[job_id]["version"]}-{resource}"'
+
+def etag_matches(request: Request, etag: str):
+    """Check whether the request's If-None-Match header matches the ETag"""
+    if_none_match = request.headers.get("if-none-match", "")
+    candidates = [candidate.strip() for candidate in if_none_match.split(",")]
+    return etag in candidates or "*" in candidates
+
+def cached_download(request: Request, job_id: str, resource: str, build_body, media_type: str, filename: str):
+    """Serve a completed job's file with ETag revalidation; build_body only runs on a cache miss"""
+    # Job results do not change once completed, so clients can cache them
+    etag = job_etag(job_id, resource)
+    headers = {"ETag": etag, "Cache-Control": "private, max-age=3600"}
+    if etag_matches(request, etag):
+        return Response(status_code=304, headers=headers)
     
-    while len(all_records) < max_records:
-        params = {
-            'order_by': 'dateparution DESC',
-            "type_marche":'Travaux',
-            'limit': limit,
-            'offset': offset,
-            
-        }
+    return StreamingResponse(
+        io.BytesIO(build_body()),
+        media_type=media_type,
+        headers={**headers, "Content-Disposition": f"attachment; filename={filename}"}
+    )
+
+# Retry settings for BOAMP API calls
+MAX_FETCH_ATTEMPTS = 5
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+
+def retry_delay(attempt: int, response: Optional[httpx.Response] = None):
+    """Seconds to wait before the next attempt, honoring Retry-After when the API sends it"""
+    # Random jitter spreads out concurrent pages so they do not all retry at once
+    retry_after = response.headers.get('Retry-After', '') if response is not None else ''
+    if retry_after.isdigit():
+        return min(int(retry_after), 60) + random.uniform(0, 1)
+    return random.uniform(0, min(0.2 * 2 ** attempt, 5))
+
+# Fetch a single page of BOAMP records
+async def fetch_records_page(client: httpx.AsyncClient, url: str, target_date: str, offset: int, limit: int):
+    """Fetch one page of BOAMP records published on the target date, retrying transient errors"""
+    params = {
+        'order_by': 'idweb',
+        "type_marche": 'Travaux',
+        'where': f"dateparution = date'{target_date}'",
+        'limit': limit,
+        'offset': offset,
+    }
+
+    for attempt in range(MAX_FETCH_ATTEMPTS):
+        last_attempt = attempt == MAX_FETCH_ATTEMPTS - 1
 
         try:
-            response = requests.get(url, params=params)
-            response.raise_for_status()
-            
-            data = response.json()
-            records = data.get('results', [])
+            response = await client.get(url, params=params)
+        except httpx.TransportError:
+            # Timeouts and connection errors are transient
+            if last_attempt:
+                raise
+            await asyncio.sleep(retry_delay(attempt))
+            continue
+
+        if response.status_code in RETRYABLE_STATUS_CODES and not last_attempt:
+            await asyncio.sleep(retry_delay(attempt, response))
+            continue
 
-            if not records:
-                break  # No more records
+        # Other client errors fail fast
+        response.raise_for_status()
+        return orjson.loads(response.content)
 
-            # Filter records for our target date
-            target_records = [record for record in records if record.get('dateparution') == target_date]
+# Main function to get BOAMP records
+async def get_all_records_for_date(client: httpx.AsyncClient, target_date, max_records=5000):
+    """Get all records for a specific date with all available fields, as a DataFrame"""
+    url = "https://boamp-datadila.opendatasoft.com/api/explore/v2.1/catalog/datasets/boamp/records"
+    limit = 100
+    max_offset = 10000
 
-            # If we found target records, add them
-            if target_records:
-                all_records.extend(target_records)
+    # Only a parsed date goes into the where clause, never the raw request value
+    target_date = date.fromisoformat(target_date).isoformat()
 
-            # Check if we've moved past our target date (since we're sorting DESC)
-            if records and records[-1].get('dateparution', '') < target_date:
-                break
+    # The first page also tells us how many records exist for the date.
+    # Fetch errors propagate so a failed page never yields a silently truncated result.
+    data = await fetch_records_page(client, url, target_date, 0, min(limit, max_records))
+    # Pages are built with dtype=object so integer fields holding nulls are not promoted to float
+    page_dfs = [pd.DataFrame(data.get('results', []), dtype=object)]
+    records_needed = min(data.get('total_count', 0), max_records, max_offset)
 
-            offset += limit
+    # Fetch the remaining pages concurrently; the task group cancels every
+    # other page as soon as one of them fails
+    offsets = range(limit, records_needed, limit)
+    try:
+        async with asyncio.TaskGroup() as group:
+            page_tasks = [
+                group.create_task(fetch_records_page(client, url, target_date, offset, min(limit, records_needed - offset)))
+                for offset in offsets
+            ]
+    except ExceptionGroup as errors:
+        raise errors.exceptions[0]
 
-            if offset > 10000:
-                break
-                
-        except requests.exceptions.RequestException as e:
-            print(f"Error fetching data: {e}")
-            break
+    for task in page_tasks:
+        page_dfs.append(pd.DataFrame(task.result().get('results', []), dtype=object))
 
-    return all_records
+    return pd.concat(page_dfs, ignore_index=True)
 
 # Function to create cleaned dataframe
-def create_excel_simple(records: List[dict], target_date: str):
+def create_excel_simple(df: pd.DataFrame, target_date: str):
     """Simple and robust Excel creation"""
-    cleaned_records = []
-    for record in records:
-        cleaned_record = {}
-        for key, value in record.items():
-            if isinstance(value, (list, dict)):
-                cleaned_record[key] = json.dumps(value, ensure_ascii=False)
-            elif value is None:
-                cleaned_record[key] = ''
-            else:
-                cleaned_record[key] = value
-        cleaned_records.append(cleaned_record)
-
-    df = pd.DataFrame(cleaned_records)
+    # Serialize nested list/dict values column by column
+    for column in [column for column in df.columns if df[column].dtype == object]:
+        mask = df[column].map(lambda value: isinstance(value, (list, dict)))
+        if mask.any():
+            df.loc[mask, column] = df.loc[mask, column].map(lambda value: orjson.dumps(value).decode('utf-8'))
+
+    df = df.fillna('')
 
     return df
 
 
 
+def parse_department_list(value: str):
+    """Parse a list-like code_departement string such as '["75","92"]' into a list"""
+    try:
+        return orjson.loads(value)
+    except orjson.JSONDecodeError:
+        pass
+
+    # Fall back to Python list reprs such as "['75', '92']"
+    try:
+        return ast.literal_eval(value)
+    except (ValueError, SyntaxError):
+        return []
+
 # Function to filter by departments - FIXED VERSION
 def filter_by_departments(df, target_departments):
+    """Filter dataframe by target departments - FIXED VERSION"""
+    target_departments = set(target_departments)
 
+    if 'code_departement' in df.columns:
+        codes = df['code_departement'].reset_index(drop=True)
+    else:
+        codes = pd.Series('', index=pd.RangeIndex(len(df)))
 
+    # Values that are already lists need no parsing
+    is_list = codes.map(lambda value: isinstance(value, list))
+    dep_lists = codes.astype(object)
 
-    
-    
-    
-    
-    """Filter dataframe by target departments - FIXED VERSION"""
-    indices_a_conserver = []
-    departements_trouves = []
+    if not is_list.all():
+        # Parse list-like strings as JSON and keep scalar codes as they are
+        text = codes[~is_list].astype('string').fillna('').str.strip()
+        dep_lists[~is_list] = text.astype(object)
 
-    for index, row in df.iterrows():
-        code_departement = row.get('code_departement', '')
-        departement_trouve = None
-        
-        # Skip if code_departement is NaN or empty
-        if pd.isna(code_departement) or code_departement == "":
-            departements_trouves.append(None)
-            continue
-            
-        # Handle different formats of code_departement
-        try:
-            # If it's a string that looks like a list, convert to list
-            if isinstance(code_departement, str):
-                # Clean the string and convert to list
-                cleaned_str = code_departement.strip('[]').replace('"', '').replace("'", "")
-                # Split by comma and clean each element
-                dep_list = [dep.strip() for dep in cleaned_str.split(',') if dep.strip()]
-            elif isinstance(code_departement, list):
-                dep_list = code_departement
-            else:
-                # Try to convert other types to string and process
-                dep_list = [str(code_departement).strip()]
-            
-            # Check if any department in the list matches our target departments
-            for dep in dep_list:
-                if dep in target_departments:
-                    indices_a_conserver.append(index)
-                    departement_trouve = dep
-                    break
-                    
-        except Exception as e:
-            print(f"Error processing row {index}: {e}")
-            dep_list = []
-        
-        departements_trouves.append(departement_trouve)
+        # Records share few distinct department lists, so parse each one only once
+        list_text = text[text.str.startswith('[')]
+        parsed = {value: parse_department_list(value) for value in list_text.unique()}
+        dep_lists[list_text.index] = list_text.map(parsed)
+
+    # One row per (record, department), as a categorical so isin compares integer codes
+    exploded = dep_lists.explode().astype('string').str.strip().astype('category')
+
+    # Keep the first matching department per record
+    first_match = exploded[exploded.isin(target_departments)].groupby(level=0).first()
 
     # Create filtered dataframe
-    if indices_a_conserver:
-        df_filtre = df.loc[indices_a_conserver].copy().reset_index(drop=True)
-        df_filtre['code_departement_trouve'] = [departements_trouves[i] for i in indices_a_conserver]
-    else:
-        # Return empty dataframe with same columns
-        df_filtre = pd.DataFrame(columns=df.columns.tolist() + ['code_departement_trouve'])
-    
+    df_filtre = df.iloc[first_match.index].reset_index(drop=True)
+    df_filtre['code_departement_trouve'] = first_match.to_numpy()
+
     return df_filtre
 
+# Function to generate Excel file bytes
+def create_excel_bytes(df: pd.DataFrame, sheet_name: str):
+    """Write a DataFrame to an in-memory Excel workbook and return its bytes"""
+    output = io.BytesIO()
+    with pd.ExcelWriter(output, engine='xlsxwriter') as writer:
+        df.to_excel(writer, index=False, sheet_name=sheet_name)
+    return output.getvalue()
+
+# Function to build job results, run in the process pool
+def build_job_results(records: pd.DataFrame, target_date: str, departments: List[str]):
+    """Create the full and filtered DataFrames and their Excel files"""
+    df = create_excel_simple(records, target_date)
+    df_filtered = filter_by_departments(df, departments)
+    return df, df_filtered, create_excel_bytes(df, 'BOAMP_Data'), create_excel_bytes(df_filtered, 'BOAMP_Filtered')
+
 # Background task for data extraction
-def process_extraction(job_id: str, target_date: str, max_records: int, departments: List[str]):
+async def process_extraction(job_id: str, target_date: str, max_records: int, departments: List[str]):
     try:
-        jobs[job_id]["status"] = "processing"
-        jobs[job_id]["message"] = "Fetching BOAMP records..."
+        update_job(job_id, status="processing", message="Fetching BOAMP records...")
         
         # Get all records
-        all_records = get_all_records_for_date(target_date, max_records)
+        all_records = await get_all_records_for_date(app.state.http, target_date, max_records)
         
-        if not all_records:
-            jobs[job_id]["status"] = "completed"
-            jobs[job_id]["message"] = f"No records found for date {target_date}"
-            jobs[job_id]["total_records"] = 0
-            jobs[job_id]["filtered_records"] = 0
+        if all_records.empty:
+            update_job(
+                job_id,
+                status="completed",
+                message=f"No records found for date {target_date}",
+                total_records=0,
+                filtered_records=0
+            )
             return
         
-        jobs[job_id]["total_records"] = len(all_records)
-        jobs[job_id]["message"] = f"Found {len(all_records)} records. Processing..."
-        
-        # Create dataframe
-        df = create_excel_simple(all_records, target_date)
-        
-        # Filter by departments
-        df_filtered = filter_by_departments(df, departments)
+        update_job(
+            job_id,
+            total_records=len(all_records),
+            message=f"Found {len(all_records)} records. Processing..."
+        )
         
-        jobs[job_id]["filtered_records"] = len(df_filtered)
-        jobs[job_id]["message"] = f"Processing complete. {len(df_filtered)} records after filtering."
-        
-        # Store results as DataFrames instead of bytes
-        jobs[job_id]["full_df"] = df
-        jobs[job_id]["filtered_df"] = df_filtered
+        # Create dataframe, filter by departments and generate Excel files off the event loop
+        loop = asyncio.get_running_loop()
+        df, df_filtered, full_xlsx, filtered_xlsx = await loop.run_in_executor(
+            app.state.executor, build_job_results, all_records, target_date, departments
+        )
         
         # Store department distribution
         if len(df_filtered) > 0 and 'code_departement_trouve' in df_filtered.columns:
             dept_counts = df_filtered['code_departement_trouve'].value_counts().to_dict()
-            jobs[job_id]["department_distribution"] = dept_counts
         else:
-            jobs[job_id]["department_distribution"] = {}
+            dept_counts = {}
         
-        jobs[job_id]["status"] = "completed"
+        # Store results as DataFrames, plus the Excel files generated once for downloads
+        update_job(
+            job_id,
+            status="completed",
+            message=f"Processing complete. {len(df_filtered)} records after filtering.",
+            filtered_records=len(df_filtered),
+            full_df=df,
+            filtered_df=df_filtered,
+            full_xlsx=full_xlsx,
+            filtered_xlsx=filtered_xlsx,
+            department_distribution=dept_counts
+        )
         
     except Exception as e:
-        jobs[job_id]["status"] = "error"
-        jobs[job_id]["message"] = f"Error during processing: {str(e)}"
+        update_job(job_id, status="error", message=f"Error during processing: {str(e)}")
         print(f"Error in process_extraction: {e}")
 
 # API Routes
 @app.post("/extract", response_model=ExtractionResponse)
-async def extract_data(request: ExtractionRequest, background_tasks: BackgroundTasks):
+async def extract_data(request: ExtractionRequest):
+    try:
+        date.fromisoformat(request.target_date)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="target_date must be a date in YYYY-MM-DD format")
+    
+    purge_jobs()
     job_id = str(uuid.uuid4())
     
     jobs[job_id] = {
         "status": "started",
         "message": "Job created, starting processing...",
+        "created_at": time.time(),
+        "version": 0,
         "target_date": request.target_date,
         "departments": request.departments,
         "total_records": 0,
@@ -228,13 +355,14 @@ async def extract_data(request: ExtractionRequest, background_tasks: BackgroundT
     }
     
     # Start background task
-    background_tasks.add_task(
-        process_extraction, 
-        job_id, 
-        request.target_date, 
-        request.max_records, 
+    task = asyncio.create_task(process_extraction(
+        job_id,
+        request.target_date,
+        request.max_records,
         request.departments
-    )
+    ))
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
     
     return ExtractionResponse(
         job_id=job_id,
@@ -243,10 +371,16 @@ async def extract_data(request: ExtractionRequest, background_tasks: BackgroundT
     )
 
 @app.get("/job/{job_id}")
-async def get_job_status(job_id: str):
+async def get_job_status(job_id: str, request: Request, response: Response):
     if job_id not in jobs:
         raise HTTPException(status_code=404, detail="Job not found")
     
+    # Let polling clients revalidate unchanged job states with a 304
+    etag = job_etag(job_id, "status")
+    if etag_matches(request, etag):
+        return Response(status_code=304, headers={"ETag": etag})
+    response.headers["ETag"] = etag
+    
     job = jobs[job_id]
     return {
         "job_id": job_id,
@@ -258,51 +392,83 @@ async def get_job_status(job_id: str):
     }
 
 @app.get("/download/{job_id}/full")
-async def download_full_data(job_id: str):
+async def download_full_data(job_id: str, request: Request):
     if job_id not in jobs or jobs[job_id]["status"] != "completed":
         raise HTTPException(status_code=404, detail="Data not available")
     
-    if "full_df" not in jobs[job_id]:
+    if "full_xlsx" not in jobs[job_id]:
         raise HTTPException(status_code=404, detail="Full data not available")
     
     target_date = jobs[job_id]["target_date"]
     timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
     filename = f"BOAMP_Full_Results_{target_date}_{timestamp}.xlsx"
     
-    # Create Excel file in memory
-    output = io.BytesIO()
-    with pd.ExcelWriter(output, engine='openpyxl') as writer:
-        jobs[job_id]["full_df"].to_excel(writer, index=False, sheet_name='BOAMP_Data')
-    output.seek(0)
-    
-    return StreamingResponse(
-        output,
-        media_type="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-        headers={"Content-Disposition": f"attachment; filename={filename}"}
+    # Serve the Excel file generated when the job completed
+    return cached_download(
+        request, job_id, "full.xlsx",
+        lambda: jobs[job_id]["full_xlsx"],
+        XLSX_MEDIA_TYPE,
+        filename
     )
 
 @app.get("/download/{job_id}/filtered")
-async def download_filtered_data(job_id: str):
+async def download_filtered_data(job_id: str, request: Request):
     if job_id not in jobs or jobs[job_id]["status"] != "completed":
         raise HTTPException(status_code=404, detail="Data not available")
     
-    if "filtered_df" not in jobs[job_id]:
+    if "filtered_xlsx" not in jobs[job_id]:
         raise HTTPException(status_code=404, detail="Filtered data not available")
     
     target_date = jobs[job_id]["target_date"]
     timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
     filename = f"BOAMP_Filtered_Results_{target_date}_{timestamp}.xlsx"
     
-    # Create Excel file in memory
-    output = io.BytesIO()
-    with pd.ExcelWriter(output, engine='openpyxl') as writer:
-        jobs[job_id]["filtered_df"].to_excel(writer, index=False, sheet_name='BOAMP_Filtered')
-    output.seek(0)
+    # Serve the Excel file generated when the job completed
+    return cached_download(
+        request, job_id, "filtered.xlsx",
+        lambda: jobs[job_id]["filtered_xlsx"],
+        XLSX_MEDIA_TYPE,
+        filename
+    )
+
+@app.get("/download/{job_id}/full.csv")
+async def download_full_data_csv(job_id: str, request: Request):
+    if job_id not in jobs or jobs[job_id]["status"] != "completed":
+        raise HTTPException(status_code=404, detail="Data not available")
     
-    return StreamingResponse(
-        output,
-        media_type="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-        headers={"Content-Disposition": f"attachment; filename={filename}"}
+    if "full_df" not in jobs[job_id]:
+        raise HTTPException(status_code=404, detail="Full data not available")
+    
+    target_date = jobs[job_id]["target_date"]
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    filename = f"BOAMP_Full_Results_{target_date}_{timestamp}.csv"
+    
+    # Build the CSV file in memory only when the client has no cached copy
+    return cached_download(
+        request, job_id, "full.csv",
+        lambda: jobs[job_id]["full_df"].to_csv(index=False).encode('utf-8-sig'),
+        "text/csv",
+        filename
+    )
+
+@app.get("/download/{job_id}/filtered.csv")
+async def download_filtered_data_csv(job_id: str, request: Request):
+    if job_id not in jobs or jobs[job_id]["status"] != "completed":
+        raise HTTPException(status_code=404, detail="Data not available")
+    
+    if "filtered_df" not in jobs[job_id]:
+        raise HTTPException(status_code=404, detail="Filtered data not available")
+    
+    target_date = jobs[job_id]["target_date"]
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    filename = f"BOAMP_Filtered_Results_{target_date}_{timestamp}.csv"
+    
+    # Build the CSV file in memory only when the client has no cached copy
+    return cached_download(
+        request, job_id, "filtered.csv",
+        lambda: jobs[job_id]["filtered_df"].to_csv(index=False).encode('utf-8-sig'),
+        "text/csv",
+        filename
     )
 
 # Serve static files
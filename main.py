@@ -1,14 +1,17 @@
 from fastapi import FastAPI, HTTPException, BackgroundTasks, Request, Form, UploadFile, File
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.middleware.gzip import GZipMiddleware
+from starlette.middleware.gzip import DEFAULT_EXCLUDED_CONTENT_TYPES
 from fastapi.responses import FileResponse, StreamingResponse, HTMLResponse, JSONResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
 from pydantic import BaseModel
 from typing import List, Optional
-import requests
+import httpx
 import pandas as pd
 from datetime import datetime, date
-import json
+import orjson
+import ast
 import io
 import uuid
 import os
@@ -18,8 +21,20 @@ import time
 import re
 import uvicorn
 import asyncio
+import random
+from contextlib import asynccontextmanager
+
+# Shared HTTP client, created at startup and closed at shutdown
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    app.state.http = httpx.AsyncClient(
+        timeout=10,
+        limits=httpx.Limits(max_connections=20, max_keepalive_connections=20)
+    )
+    yield
+    await app.state.http.aclose()
 
-app = FastAPI(title="BOAMP Data Extractor Pro", version="3.0.0")
+app = FastAPI(title="BOAMP Data Extractor Pro", version="3.0.0", lifespan=lifespan)
 
 # Create directories if they don't exist
 os.makedirs("static", exist_ok=True)
@@ -38,6 +53,14 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# GZip middleware for large JSON and CSV responses; xlsx is already a ZIP archive
+XLSX_MEDIA_TYPE = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+app.add_middleware(
+    GZipMiddleware,
+    minimum_size=1024,
+    exclude_content_types=(*DEFAULT_EXCLUDED_CONTENT_TYPES, XLSX_MEDIA_TYPE)
+)
+
 # Models
 class ExtractionRequest(BaseModel):
     target_date: str
@@ -55,70 +78,96 @@ class ExtractionResponse(BaseModel):
 jobs = {}
 processing_state = {}
 
-# Main function to get BOAMP records
-def get_all_records_for_date(target_date, max_records=5000):
-    """Get all records for a specific date with all available fields"""
-    url = "https://boamp-datadila.opendatasoft.com/api/explore/v2.1/catalog/datasets/boamp/records"
-    all_records = []
-    offset = 0
-    limit = 100
-    
-    while len(all_records) < max_records:
-        params = {
-            'order_by': 'dateparution DESC',
-            "type_marche": 'Travaux',
-            'limit': limit,
-            'offset': offset,
-        }
+# References to running background tasks so they are not garbage-collected mid-run
+background_tasks = set()
+
+# Retry settings for BOAMP API calls
+MAX_FETCH_ATTEMPTS = 5
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+
+def retry_delay(attempt: int, response: Optional[httpx.Response] = None):
+    """Seconds to wait before the next attempt, honoring Retry-After when the API sends it"""
+    # Random jitter spreads out concurrent pages so they do not all retry at once
+    retry_after = response.headers.get('Retry-After', '') if response is not None else ''
+    if retry_after.isdigit():
+        return min(int(retry_after), 60) + random.uniform(0, 1)
+    return random.uniform(0, min(0.2 * 2 ** attempt, 5))
+
+# Fetch a single page of BOAMP records
+async def fetch_records_page(client: httpx.AsyncClient, url: str, target_date: str, offset: int, limit: int):
+    """Fetch one page of BOAMP records published on the target date, retrying transient errors"""
+    params = {
+        'order_by': 'idweb',
+        "type_marche": 'Travaux',
+        'where': f"dateparution = date'{target_date}'",
+        'limit': limit,
+        'offset': offset,
+    }
+
+    for attempt in range(MAX_FETCH_ATTEMPTS):
+        last_attempt = attempt == MAX_FETCH_ATTEMPTS - 1
 
         try:
-            response = requests.get(url, params=params)
-            response.raise_for_status()
-            
-            data = response.json()
-            records = data.get('results', [])
+            response = await client.get(url, params=params)
+        except httpx.TransportError:
+            # Timeouts and connection errors are transient
+            if last_attempt:
+                raise
+            await asyncio.sleep(retry_delay(attempt))
+            continue
+
+        if response.status_code in RETRYABLE_STATUS_CODES and not last_attempt:
+            await asyncio.sleep(retry_delay(attempt, response))
+            continue
 
-            if not records:
-                break  # No more records
+        # Other client errors fail fast
+        response.raise_for_status()
+        return orjson.loads(response.content)
 
-            # Filter records for our target date
-            target_records = [record for record in records if record.get('dateparution') == target_date]
+# Main function to get BOAMP records
+async def get_all_records_for_date(client: httpx.AsyncClient, target_date, max_records=5000):
+    """Get all records for a specific date with all available fields, as a DataFrame"""
+    url = "https://boamp-datadila.opendatasoft.com/api/explore/v2.1/catalog/datasets/boamp/records"
+    limit = 100
+    max_offset = 10000
 
-            # If we found target records, add them
-            if target_records:
-                all_records.extend(target_records)
+    # Only a parsed date goes into the where clause, never the raw request value
+    target_date = date.fromisoformat(target_date).isoformat()
 
-            # Check if we've moved past our target date (since we're sorting DESC)
-            if records and records[-1].get('dateparution', '') < target_date:
-                break
+    # The first page also tells us how many records exist for the date.
+    # Fetch errors propagate so a failed page never yields a silently truncated result.
+    data = await fetch_records_page(client, url, target_date, 0, min(limit, max_records))
+    # Pages are built with dtype=object so integer fields holding nulls are not promoted to float
+    page_dfs = [pd.DataFrame(data.get('results', []), dtype=object)]
+    records_needed = min(data.get('total_count', 0), max_records, max_offset)
 
-            offset += limit
+    # Fetch the remaining pages concurrently; the task group cancels every
+    # other page as soon as one of them fails
+    offsets = range(limit, records_needed, limit)
+    try:
+        async with asyncio.TaskGroup() as group:
+            page_tasks = [
+                group.create_task(fetch_records_page(client, url, target_date, offset, min(limit, records_needed - offset)))
+                for offset in offsets
+            ]
+    except ExceptionGroup as errors:
+        raise errors.exceptions[0]
 
-            if offset > 10000:
-                break
-                
-        except requests.exceptions.RequestException as e:
-            print(f"Error fetching data: {e}")
-            break
+    for task in page_tasks:
+        page_dfs.append(pd.DataFrame(task.result().get('results', []), dtype=object))
 
-    return all_records
+    return pd.concat(page_dfs, ignore_index=True)
 
 # Function to create cleaned dataframe
-def create_excel_simple(records: List[dict], target_date: str):
+def create_excel_simple(df: pd.DataFrame, target_date: str):
     """Simple and robust Excel creation"""
-    cleaned_records = []
-    for record in records:
-        cleaned_record = {}
-        for key, value in record.items():
-            if isinstance(value, (list, dict)):
-                cleaned_record[key] = json.dumps(value, ensure_ascii=False)
-            elif value is None:
-                cleaned_record[key] = ''
-            else:
-                cleaned_record[key] = value
-        cleaned_records.append(cleaned_record)
+    # Serialize nested list/dict values column by column
+    for column in [column for column in df.columns if df[column].dtype == object]:
+        mask = df[column].map(lambda value: isinstance(value, (list, dict)))
+        if mask.any():
+            df.loc[mask, column] = df.loc[mask, column].map(lambda value: orjson.dumps(value).decode('utf-8'))
 
-    df = pd.DataFrame(cleaned_records)
+    df = df.fillna('')
     return df
 
 def get_predefined_keywords():
@@ -202,53 +251,58 @@ def remove_duplicates(df: pd.DataFrame, id_column: str, keyword_column: str):
     df_clean = df.groupby(id_column).apply(combine_keywords).reset_index(drop=True)
     return df_clean
 
+def parse_department_list(value: str):
+    """Parse a list-like code_departement string such as '["75","92"]' into a list"""
+    try:
+        return orjson.loads(value)
+    except orjson.JSONDecodeError:
+        pass
+
+    # Fall back to Python list reprs such as "['75', '92']"
+    try:
+        return ast.literal_eval(value)
+    except (ValueError, SyntaxError):
+        return []
+
 def filter_by_departments(df, target_departments):
     """Filter dataframe by target departments"""
     if not target_departments:
         return df
-    
-    indices_a_conserver = []
-    departements_trouves = []
 
-    for index, row in df.iterrows():
-        code_departement = row.get('code_departement', '')
-        departement_trouve = None
-        
-        # Check if code_departement is a valid list
-        if pd.notna(code_departement) and code_departement != "":
-            # If it's a string that looks like a list, convert to list
-            if isinstance(code_departement, str):
-                try:
-                    # Remove brackets and quotes, then split
-                    code_departement = code_departement.strip('[]').replace('"', '').replace("'", "").split(', ')
-                    # Clean elements
-                    code_departement = [dep.strip() for dep in code_departement if dep.strip()]
-                except:
-                    code_departement = []
-            elif not isinstance(code_departement, list):
-                code_departement = []
-            
-            # Check if at least one department from the list is in target departments
-            for dep in code_departement:
-                if dep in target_departments:
-                    indices_a_conserver.append(index)
-                    departement_trouve = dep  # Store found department
-                    break  # Exit loop as soon as we find a match
-        
-        # Add found department (or None if none)
-        departements_trouves.append(departement_trouve)
-
-    # Create new DataFrame with only kept rows
-    if indices_a_conserver:
-        df_filtre = df.loc[indices_a_conserver].reset_index(drop=True)
-        # Add column with found department code
-        df_filtre['code_departement_trouve'] = [departements_trouves[i] for i in indices_a_conserver]
+    target_departments = set(target_departments)
+
+    if 'code_departement' in df.columns:
+        codes = df['code_departement'].reset_index(drop=True)
     else:
-        df_filtre = pd.DataFrame(columns=df.columns)
-    
+        codes = pd.Series('', index=pd.RangeIndex(len(df)))
+
+    # Values that are already lists need no parsing
+    is_list = codes.map(lambda value: isinstance(value, list))
+    dep_lists = codes.astype(object)
+
+    if not is_list.all():
+        # Parse list-like strings as JSON and keep scalar codes as they are
+        text = codes[~is_list].astype('string').fillna('').str.strip()
+        dep_lists[~is_list] = text.astype(object)
+
+        # Records share few distinct department lists, so parse each one only once
+        list_text = text[text.str.startswith('[')]
+        parsed = {value: parse_department_list(value) for value in list_text.unique()}
+        dep_lists[list_text.index] = list_text.map(parsed)
+
+    # One row per (record, department), as a categorical so isin compares integer codes
+    exploded = dep_lists.explode().astype('string').str.strip().astype('category')
+
+    # Keep the first matching department per record
+    first_match = exploded[exploded.isin(target_departments)].groupby(level=0).first()
+
+    # Create new DataFrame with only kept rows and the found department code
+    df_filtre = df.iloc[first_match.index].reset_index(drop=True)
+    df_filtre['code_departement_trouve'] = first_match.to_numpy()
+
     return df_filtre
 
-def extract_pdf_content(df: pd.DataFrame, process_id: str):
+async def extract_pdf_content(client: httpx.AsyncClient, df: pd.DataFrame, process_id: str):
     """Extract PDF content and analyze for lots and visite information"""
     if df.empty:
         return df
@@ -270,10 +324,14 @@ def extract_pdf_content(df: pd.DataFrame, process_id: str):
     processing_state[process_id]['total_records'] = total_records
     processing_state[process_id]['processed_records'] = 0
     
-    for index, row in df_with_pdf.iterrows():
-        dateparution_str = row.get('dateparution')
-        idweb = row.get('idweb', 'N/A')
-        keywords_from_row = row.get('keyword', '')
+    # Iterate plain tuples over the columns we read instead of building a Series per row
+    row_values = pd.DataFrame({
+        'dateparution': df_with_pdf.get('dateparution'),
+        'idweb': df_with_pdf.get('idweb', 'N/A'),
+        'keyword': df_with_pdf.get('keyword', ''),
+    }, index=df_with_pdf.index)
+    
+    for index, dateparution_str, idweb, keywords_from_row in row_values.itertuples(index=True, name=None):
         
         # Update progress
         processing_state[process_id]['processed_records'] = index + 1
@@ -314,7 +372,7 @@ def extract_pdf_content(df: pd.DataFrame, process_id: str):
             # Download and extract PDF content
             try:
                 # Download the PDF
-                response = requests.get(link, timeout=30)
+                response = await client.get(link, timeout=30, follow_redirects=True)
                 response.raise_for_status()
                 
                 # Save to temporary file
@@ -369,7 +427,7 @@ def extract_pdf_content(df: pd.DataFrame, process_id: str):
                 errors += 1
             
             # Add a small delay to be respectful to the server
-            time.sleep(0.5)
+            await asyncio.sleep(0.5)
             
         except Exception as e:
             error_msg = f"Error processing row: {str(e)}"
@@ -500,6 +558,11 @@ async def process_data(
     selected_departments: str = Form("")  # New parameter for departments from map
 ):
     """Start the data processing"""
+    try:
+        date.fromisoformat(target_date)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="target_date must be a date in YYYY-MM-DD format")
+    
     process_id = f"process_{int(time.time())}_{uuid.uuid4().hex[:8]}"
     
     # Combine keywords
@@ -535,7 +598,9 @@ async def process_data(
     }
     
     # Run processing in background
-    asyncio.create_task(run_processing(process_id, target_date, all_keywords, target_departments_list))
+    task = asyncio.create_task(run_processing(process_id, target_date, all_keywords, target_departments_list))
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
     
     return JSONResponse({
         "process_id": process_id, 
@@ -552,9 +617,9 @@ async def run_processing(process_id: str, target_date: str, all_keywords: List[s
         processing_state[process_id]['current_step'] = 'data_extraction'
         processing_state[process_id]['status'] = 'processing'
         
-        all_records = get_all_records_for_date(target_date, MAX_RECORDS)
+        all_records = await get_all_records_for_date(app.state.http, target_date, MAX_RECORDS)
         
-        if not all_records:
+        if all_records.empty:
             processing_state[process_id]['status'] = 'completed'
             processing_state[process_id]['message'] = f"No records found for date {target_date}"
             return
@@ -591,7 +656,7 @@ async def run_processing(process_id: str, target_date: str, all_keywords: List[s
         
         # Step 5: Process PDFs
         processing_state[process_id]['current_step'] = 'pdf_processing'
-        processed_df = extract_pdf_content(df_final, process_id)
+        processed_df = await extract_pdf_content(app.state.http, df_final, process_id)
         
         # Create summary table
         summary_table = pd.DataFrame({
@@ -640,7 +705,7 @@ async def download_results(process_id: str):
     
     # Create Excel file in memory
     excel_buffer = io.BytesIO()
-    df.to_excel(excel_buffer, index=False, engine='openpyxl')
+    df.to_excel(excel_buffer, index=False, engine='xlsxwriter')
     excel_buffer.seek(0)
     
     target_date = processing_state[process_id].get('target_date', 'unknown')
@@ -648,7 +713,7 @@ async def download_results(process_id: str):
     
     return StreamingResponse(
         excel_buffer,
-        media_type="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+        media_type=XLSX_MEDIA_TYPE,
         headers={"Content-Disposition": f"attachment; filename={filename}"}
     )
 